@@ -1,28 +1,65 @@
 import csv
-import subprocess
 import json
 import argparse
+import logging
+from itertools import islice
+from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, as_completed, wait
+from concurrent.futures.process import BrokenProcessPool
+from pc_to_netcdf import main as convert_one, setup_logging
 
-def run_script(csv_file):
-    # Define the known argument names for the command
-    known_args = [
-        'ply_filepath', 'las_filepath', 'hdr_filepath', 'xcoord', 'ycoord', 'zcoord',
-        'crs_config', 'output_filepath'
-    ]
+logger = logging.getLogger(__name__)
 
+# Columns in the CSV file that are arguments of pc_to_netcdf.py. All other columns are global attributes
+known_args = [
+    'ply_filepath', 'las_filepath', 'hdr_filepath', 'xcoord', 'ycoord', 'zcoord',
+    'crs_config', 'variable_mapping', 'output_filepath'
+]
+known_args_set = frozenset(known_args)
+
+def convert_row(argv, workers=1):
+    '''
+    Convert the point cloud listed in one row of the CSV file within the current process
+    workers: number of rows being converted at the same time, which share the available memory
+    '''
+    setup_logging()
+    try:
+        convert_one(argv, workers)
+    except SystemExit as e:
+        # Raised by argparse or pc_to_netcdf when the arguments in the row are invalid
+        if e.code:
+            logger.error(f'Conversion failed for arguments {argv}')
+    except Exception:
+        # One bad row does not stop the other rows from being converted
+        logger.exception(f'Conversion failed for arguments {argv}')
+
+def check_result(future, argv):
+    '''
+    Log a row that failed in a worker process, so that the other rows are still converted
+    A broken pool, e.g. a worker killed by the system when out of memory, stops the batch
+    '''
+    try:
+        future.result()
+    except BrokenProcessPool:
+        logger.error(f'A worker process died while converting arguments {argv}. Stopping')
+        raise
+    except Exception:
+        logger.exception(f'Conversion failed for arguments {argv}')
+
+def iter_rows_args(csv_file):
+    '''
+    Yield the list of arguments for pc_to_netcdf.py for each row of the CSV file
+    Rows are read as they are needed rather than all up front
+    '''
     with open(csv_file, mode='r') as file:
         reader = csv.DictReader(file)
+        # The header is the same for every row, so the global attribute columns are found once
+        attribute_columns = [column for column in reader.fieldnames or [] if column not in known_args_set]
         for row in reader:
-            # Prepare the list of arguments
-            args = []
-
             # Add known arguments if they are present in the row
-            for arg in known_args:
-                if row.get(arg):
-                    args.append(f'--{arg}={row[arg]}')
+            args = [f'--{arg}={row[arg]}' for arg in known_args if row.get(arg)]
 
             # Remaining columns as global_attributes dictionary
-            global_attributes = {k: row[k] for k in row.keys() if k not in known_args}
+            global_attributes = {column: row[column] for column in attribute_columns}
 
             # Convert the dictionary to a JSON string to pass as an argument
             global_attributes_json = json.dumps(global_attributes)
@@ -30,16 +67,55 @@ def run_script(csv_file):
             # Add the global_attributes argument
             args.append(f'--global_attributes={global_attributes_json}')
 
-            # Run the script with subprocess and pass the arguments
-            subprocess.run(['python3', 'pc_to_netcdf.py'] + args)
+            yield args
+
+def mpi_rank_and_size():
+    '''
+    Rank of this process and the number of processes when launched with mpirun
+    mpi4py is optional, without it the script runs as a single process
+    '''
+    try:
+        from mpi4py import MPI
+    except ImportError:
+        return 0, 1
+    comm = MPI.COMM_WORLD
+    return comm.Get_rank(), comm.Get_size()
+
+def run_script(csv_file, workers=1):
+    # When launched with mpirun, each rank converts a disjoint subset of the rows
+    rank, size = mpi_rank_and_size()
+    rows_args = islice(iter_rows_args(csv_file), rank, None, size)
+
+    # Conversions that may run at the same time. All ranks are counted, as they may share a node
+    concurrent = max(1, workers) * size
+
+    # Run the conversion in-process, avoiding the start up of a new interpreter for each row
+    if workers > 1:
+        # Rows are independent so they can be converted in parallel
+        # At most two rows per worker are submitted at once, bounding the memory held by queued rows
+        # Each future is kept with the arguments of its row, so that failures can be reported
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            pending = {}
+            for args in rows_args:
+                if len(pending) >= 2 * workers:
+                    done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        check_result(future, pending.pop(future))
+                pending[executor.submit(convert_row, args, concurrent)] = args
+            for future in as_completed(pending):
+                check_result(future, pending[future])
+    else:
+        for args in rows_args:
+            convert_row(args, concurrent)
 
 if __name__ == "__main__":
     # Set up argument parser to take CSV filepath as an argument
     parser = argparse.ArgumentParser(description='Run script for each row in the CSV file.')
     parser.add_argument('csv_filepath', type=str, help='Path to the CSV file.')
+    parser.add_argument('-w', '--workers', type=int, default=1, help='Number of files to convert in parallel. Defaults to 1.')
 
     # Parse the arguments
     args = parser.parse_args()
 
     # Call run_script with the provided CSV file
-    run_script(args.csv_filepath)
\ No newline at end of file
+    run_script(args.csv_filepath, args.workers)
@@ -2,17 +2,231 @@
 import netCDF4 as nc
 import numpy as np
 import logging
+import os
+import queue
+import threading
+from lib.variable_mapping import match_columns, valid_range_attributes
+from lib.utils import is_empty
 
 logger = logging.getLogger(__name__)
 
+# Compression methods that can be used for the data variables, with the level used for each
+# zstd and blosc depend on the filters netCDF-C was built with, zlib is always available
+compression_levels = {'zlib': 4, 'zstd': 3, 'blosc_lz4': 5, 'blosc_zstd': 3}
+compression_support = {
+    'zlib': True,
+    'zstd': bool(getattr(nc, '__has_zstandard_support__', False)),
+    'blosc_lz4': bool(getattr(nc, '__has_blosc_support__', False)),
+    'blosc_zstd': bool(getattr(nc, '__has_blosc_support__', False))
+}
+# Default chunk length along the point dimension for 1D variables, roughly 1 MiB of f4 per chunk
+POINT_CHUNK_1D = 262144
+# Target size of each chunk of the 2D intensity variable, which is given its own larger chunk cache
+INTENSITY_CHUNK_BYTES = 1024 * 1024
+INTENSITY_CHUNK_CACHE_SIZE = 64 * 1024 * 1024
+INTENSITY_CHUNK_CACHE_NELEMS = 4001
+# Intensity data are converted and written in slabs of whole chunks of at least this size
+INTENSITY_SLAB_BYTES = 16 * 1024 * 1024
+# Number of converted slabs that can wait to be written
+INTENSITY_SLAB_QUEUE = 2
+# Below this size the compression overhead outweighs the savings, so variables are left contiguous
+MIN_BYTES_TO_COMPRESS = 64 * 1024
+# Per-variable HDF5 chunk cache
+CHUNK_CACHE_SIZE = 16 * 1024 * 1024
+CHUNK_CACHE_NELEMS = 521
+CHUNK_CACHE_PREEMPTION = 0.75
+
+# Files are built in memory and written to disk once on closing if they take up less than this fraction of the available memory
+DISKLESS_MEMORY_FRACTION = 0.5
+# Extra memory allowed for HDF5 metadata and buffers when a file is built in memory, as a fraction of the data size
+DISKLESS_HDF5_HEADROOM = 0.25
+
+# NetCDF formats that can be written. HDF5 based formats support chunking and compression
+netcdf_formats = ['NETCDF4', 'NETCDF4_CLASSIC', 'NETCDF3_64BIT_DATA', 'NETCDF3_64BIT_OFFSET', 'NETCDF3_CLASSIC']
+hdf5_formats = ['NETCDF4', 'NETCDF4_CLASSIC']
+# The classic data model has no unsigned integers, so these are stored in the next larger signed type
+classic_model_dtypes = {'u1': 'i2', 'u2': 'i4'}
+classic_model_formats = ['NETCDF4_CLASSIC', 'NETCDF3_64BIT_OFFSET', 'NETCDF3_CLASSIC']
+
+def to_dtype(values, dtype):
+    '''
+    Cast an array to the dtype of the NetCDF variable
+    Floats are rounded and clipped to the range of integer dtypes so that they do not wrap around
+    '''
+    dtype = np.dtype(dtype)
+    if dtype.kind in 'iu' and values.dtype.kind == 'f':
+        info = np.iinfo(dtype)
+        values = np.clip(np.rint(values), info.min, info.max)
+    return values.astype(dtype, copy=False)
+
+def typed_attributes(attributes, dtype):
+    '''
+    Cast the valid_min, valid_max and valid_range attributes to the dtype of the variable, as required by CF
+    '''
+    if np.dtype(dtype).kind not in 'iuf':
+        return attributes
+    return {
+        attribute: np.array(value, dtype=dtype) if attribute in valid_range_attributes else value
+        for attribute, value in attributes.items()
+    }
+
+def available_memory():
+    '''
+    Bytes of memory available without swapping, including page cache that can be reclaimed
+    Read from MemAvailable in /proc/meminfo on Linux, otherwise the free physical memory is used
+    None if this cannot be determined on the platform
+    '''
+    try:
+        with open('/proc/meminfo') as meminfo:
+            for line in meminfo:
+                if line.startswith('MemAvailable:'):
+                    # Given in kB
+                    return int(line.split()[1]) * 1024
+    except (OSError, ValueError, IndexError):
+        pass
+    try:
+        return os.sysconf('SC_AVPHYS_PAGES') * os.sysconf('SC_PAGE_SIZE')
+    except (AttributeError, ValueError, OSError):
+        return None
+
+def number_of_points(pc_df):
+    '''
+    Number of points in a dataframe or a mapping of column names to 1D arrays
+    '''
+    columns = list(pc_df.keys())
+    return len(pc_df[columns[0]]) if columns else 0
+
+def column_values(pc_df, colname):
+    '''
+    Values of a column of a dataframe or a mapping of column names to 1D arrays, without copying
+    '''
+    return np.asarray(pc_df[colname])
+
+def output_size(pc_df, wavelength_df, variable_mapping):
+    '''
+    Estimated bytes of the uncompressed variables written to the NetCDF file
+    '''
+    num_points = number_of_points(pc_df)
+    column_mapping, _ = match_columns(pc_df.keys(), variable_mapping)
+    # The f4 point coordinate variable and a 1D variable in its own dtype for each matched column
+    point_bytes = 4 + sum(np.dtype(variable_mapping[variable]['dtype']).itemsize for variable in column_mapping.values())
+    nbytes = num_points * point_bytes
+    if wavelength_df is not None:
+        # f4 intensity variable and band coordinate variable
+        num_bands = wavelength_df.shape[1]
+        nbytes += (num_points + 1) * num_bands * 4
+    return nbytes
+
+def fits_in_memory(pc_df, wavelength_df, variable_mapping, workers=1):
+    '''
+    True if the NetCDF file, with room for HDF5 metadata and buffers, fits comfortably within the available memory
+    The input data are already in memory, so are not counted again
+    workers: number of conversions running at the same time on the machine, which share the available memory
+    '''
+    memory = available_memory()
+    if memory is None:
+        return False
+    nbytes = output_size(pc_df, wavelength_df, variable_mapping) * (1 + DISKLESS_HDF5_HEADROOM)
+    return nbytes < memory * DISKLESS_MEMORY_FRACTION / max(1, workers)
+
+def prefetch(iterable, size):
+    '''
+    Iterate over iterable in a background thread, with at most size items waiting for the consumer
+    Lets the next item be prepared while the current one is being processed
+    Exceptions raised by iterable are raised again in the consumer
+    '''
+    items = queue.Queue(maxsize=size)
+    stop = threading.Event()
+    end = object()
+
+    def put(item):
+        # Give up if the consumer has stopped, rather than block forever on a full queue
+        while not stop.is_set():
+            try:
+                items.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def produce():
+        try:
+            for item in iterable:
+                if not put((item, None)):
+                    return
+        except Exception as e:
+            put((end, e))
+        else:
+            put((end, None))
+
+    thread = threading.Thread(target=produce, daemon=True)
+    thread.start()
+    try:
+        while True:
+            item, error = items.get()
+            if error is not None:
+                raise error
+            if item is end:
+                return
+            yield item
+    finally:
+        stop.set()
+        thread.join()
+
 class NetCDF:
 
-    def __init__(self, output_filepath):
+    def __init__(self, output_filepath, netcdf_format='NETCDF4', diskless=False, compression='zlib'):
         self.output_filepath = output_filepath
-        self.ncfile = nc.Dataset(self.output_filepath, mode='w', format='NETCDF4')
+        self.netcdf_format = netcdf_format
+        if not compression_support.get(compression, False):
+            logger.warning(f'{compression} compression is not available in this netCDF4 build, zlib will be used instead')
+            compression = 'zlib'
+        self.compression = compression
+        # A diskless file is held in memory and written to disk in one go when it is closed
+        self.ncfile = nc.Dataset(
+            self.output_filepath,
+            mode='w',
+            format=self.netcdf_format,
+            diskless=diskless,
+            persist=diskless
+            )
+        # Every variable is fully written after it is created, so prefilling with fill values is wasted I/O
+        self.ncfile.set_fill_off()
+        self.num_points = None
 
-    # def calculate_vertical_bounds(self, altitude_values):
-    #     return np.min(altitude_values), np.max(altitude_values)
+    def _storage_kwargs(self, shape, dtype, chunksizes):
+        '''
+        Chunking and compression arguments for createVariable
+        Small variables, and formats without HDF5 support, are written contiguous and uncompressed
+        '''
+        nbytes = int(np.prod(shape)) * np.dtype(dtype).itemsize
+        if self.netcdf_format not in hdf5_formats or nbytes < MIN_BYTES_TO_COMPRESS:
+            return {}
+        kwargs = {
+            'compression': self.compression,
+            'complevel': compression_levels[self.compression],
+            'chunksizes': chunksizes
+        }
+        # netCDF4 only applies the HDF5 shuffle filter together with zlib, blosc shuffles bytes itself
+        if self.compression == 'zlib':
+            kwargs['shuffle'] = True
+        return kwargs
+
+    def _storage_dtype(self, dtype):
+        '''
+        dtype that the variable can be stored as in the output format
+        '''
+        if self.netcdf_format in classic_model_formats:
+            return classic_model_dtypes.get(dtype, dtype)
+        return dtype
+
+    def _set_chunk_cache(self, variable, size=CHUNK_CACHE_SIZE, nelems=CHUNK_CACHE_NELEMS):
+        if self.netcdf_format in hdf5_formats and variable.chunking() != 'contiguous':
+            variable.set_var_chunk_cache(
+                size=size,
+                nelems=nelems,
+                preemption=CHUNK_CACHE_PREEMPTION
+                )
 
     def define_grid_mapping(self, cf_crs):
         '''
@@ -20,8 +234,8 @@ class NetCDF:
         '''
         crs = self.ncfile.createVariable('crs', 'i4')
 
-        for attr, value in cf_crs.items():
-            crs.setncattr(attr, value)
+        # Write all the grid mapping attributes in one call
+        crs.setncatts(cf_crs)
 
     def write_coordinate_variables(self, pc_df, wavelength_df, variable_mapping):
 
@@ -29,115 +243,161 @@ class NetCDF:
             num_points, num_bands = wavelength_df.shape
             wavelengths = wavelength_df.columns
         else:
-            num_points = len(pc_df)
+            num_points = number_of_points(pc_df)
             num_bands = None
             wavelengths = None
 
+        self.num_points = num_points
+
         # Define a dimension as an arbitrary counter for the points
         self.ncfile.createDimension('point', size=num_points)
         # Write coordinate variable
-        point_var = self.ncfile.createVariable('point', 'f4', ('point',), zlib=True, complevel=1)
-        point_var[:] = range(num_points)
+        point_var = self.ncfile.createVariable(
+            'point',
+            'f4',
+            ('point',),
+            **self._storage_kwargs((num_points,), 'f4', (min(num_points, POINT_CHUNK_1D),))
+            )
         # Adding variable attributes
-        point_var.setncattr('units', '1')
-        point_var.setncattr('long_name', 'Arbitrary counter for number of points in the point cloud')
-        point_var.setncattr('standard_name', 'number_of_observations')
-        point_var.setncattr('coverage_content_type', 'coordinate')
+        point_var.setncatts({
+            'units': '1',
+            'long_name': 'Arbitrary counter for number of points in the point cloud',
+            'standard_name': 'number_of_observations',
+            'coverage_content_type': 'coordinate'
+            })
+        point_var[:] = np.arange(num_points, dtype=np.float32)
         logger.info('Wrote a coordinate variable for each point')
 
         if num_bands:
             # Define a dimension and coordinate variable for the wavelength bands
             self.ncfile.createDimension('band', size=num_bands)
-            wavelength_var = self.ncfile.createVariable('band', 'f4', ('band',), zlib=True, complevel=1)
-            wavelength_var[:] = wavelengths
-
-            wavelength_var.setncattr('units', 'nanometers')
-            wavelength_var.setncattr('long_name', 'Spectral band')
-            wavelength_var.setncattr('standard_name', 'radiation_wavelength')
-            wavelength_var.setncattr('coverage_content_type', 'coordinate')
+            wavelength_var = self.ncfile.createVariable(
+                'band',
+                'f4',
+                ('band',),
+                **self._storage_kwargs((num_bands,), 'f4', (num_bands,))
+                )
+            wavelength_var.setncatts({
+                'units': 'nanometers',
+                'long_name': 'Spectral band',
+                'standard_name': 'radiation_wavelength',
+                'coverage_content_type': 'coordinate'
+                })
+            wavelength_var[:] = np.asarray(wavelengths, dtype=np.float32)
             logger.info('Wrote a coordinate variable for each wavelength band')
 
-    def write_1d_data(self, pc_df, variable_mapping, chunk_size):
-
-        # Loop through columns in input data
-        for col in pc_df.columns:
-            # Loop through variables in mapping configuration file
-            for variable in variable_mapping.keys():
-                if 'possible_names' in variable_mapping[variable].keys():
-                    # Matching input data to variable in config file with metadata
-                    if col in variable_mapping[variable]['possible_names']:
-                        # Initialising variable
-                        netcdf_variable = self.ncfile.createVariable(
-                            variable,
-                            variable_mapping[variable]['dtype'],
-                            ('point',),
-                            zlib=True,
-                            complevel=1,
-                            chunksizes=(chunk_size,)
-                            )
-                        # Writing data to variable
-                        netcdf_variable[:] = pc_df[col]
-                        # Writing variable attributes
-                        for attribute, value in variable_mapping[variable]['attributes'].items():
-                            netcdf_variable.setncattr(attribute, value)
-                        logger.info(f'Data and metadata written to {variable} variable')
+    def _write_cols(self, pc_df, specs):
+        '''
+        Write columns of the dataframe to 1D variables along the point dimension
+        specs: list of (colname, variable, variable_spec) tuples
+        '''
+        chunksizes = (min(self.num_points, POINT_CHUNK_1D),)
+        present = set(pc_df.keys())
+
+        for colname, variable, variable_spec in specs:
+            if colname not in present:
+                continue
+            dtype = self._storage_dtype(variable_spec['dtype'])
+            # Initialising variable
+            netcdf_variable = self.ncfile.createVariable(
+                variable,
+                dtype,
+                ('point',),
+                **self._storage_kwargs((self.num_points,), dtype, chunksizes)
+                )
+            self._set_chunk_cache(netcdf_variable)
+            # Writing all variable attributes in one call, before any data are written
+            netcdf_variable.setncatts(typed_attributes(variable_spec['attributes'], dtype))
+            # Data are written as plain arrays, no masked array wrapping required
+            netcdf_variable.set_auto_mask(False)
+            # Writing data to variable, converted once to the variable dtype
+            # No copy is made if the column already has the dtype of the variable
+            netcdf_variable[:] = to_dtype(column_values(pc_df, colname), dtype)
+            logger.info(f'Data and metadata written to {variable} variable')
+
+    def write_1d_data(self, pc_df, variable_mapping):
+
+        # Matching input data to variables in config file with metadata
+        column_mapping, _ = match_columns(pc_df.keys(), variable_mapping)
+        specs = [(col, variable, variable_mapping[variable]) for col, variable in column_mapping.items()]
+
+        self._write_cols(pc_df, specs)
 
     def write_2d_data(self, wavelength_df, variable_mapping, chunk_size):
 
         num_points, num_bands = wavelength_df.shape
 
+        # Chunks span all bands, with as many points as fit in the target chunk size unless specified
+        chunk_rows = chunk_size or max(1, INTENSITY_CHUNK_BYTES // (num_bands * 4))
+        chunk_rows = min(num_points, chunk_rows)
+
         # Initialize the variable
         intensity = self.ncfile.createVariable(
             'intensity',
             'f4',
             ('point','band'),
-            zlib=True,
-            complevel=1, #TODO: Test complevel on file size
-            chunksizes=(chunk_size,num_bands)
+            **self._storage_kwargs((num_points, num_bands), 'f4', (chunk_rows, num_bands))
             )
+        self._set_chunk_cache(intensity, size=INTENSITY_CHUNK_CACHE_SIZE, nelems=INTENSITY_CHUNK_CACHE_NELEMS)
+
+        # Assign intensity variable attributes before any data are written
+        intensity.setncatts(variable_mapping['intensity']['attributes'])
 
-        # Add values to the intensity variable
-        intensity[:] = wavelength_df
+        # Add values to the intensity variable in slabs of whole chunks, so that only a few slabs at a time
+        # are converted to C-contiguous f4 blocks and no chunk is written twice
+        chunks_per_slab = max(1, INTENSITY_SLAB_BYTES // (chunk_rows * num_bands * 4))
+        slab_rows = chunk_rows * chunks_per_slab
 
-        # Assign intensity variable attributes
-        for attribute, value in variable_mapping['intensity']['attributes'].items():
-            intensity.setncattr(attribute, value)
+        def slabs():
+            for start in range(0, num_points, slab_rows):
+                slab = wavelength_df.iloc[start:start + slab_rows]
+                yield start, np.ascontiguousarray(slab.to_numpy(dtype=np.float32))
+
+        # The next slabs are converted in another thread while the current one is compressed and written
+        # Both NumPy and netCDF-C release the GIL, so the two run at the same time
+        for start, slab in prefetch(slabs(), INTENSITY_SLAB_QUEUE):
+            intensity[start:start + len(slab)] = slab
 
         logger.info('2D intensity data and metadata written to file')
 
     def assign_global_attributes(self,global_attributes):
+        # Attributes already in the file are not overwritten
+        existing = set(self.ncfile.ncattrs())
+        attributes_to_write = {}
         for attribute, value in global_attributes.items():
-            if attribute not in self.ncfile.ncattrs() and value not in [np.nan, '', 'None', None, 'nan']:
-                # if format == 'string':
-                #     self.ncfile.setncattr_string(attribute, value)
-                # elif format == 'number':
-                #     value = float(value)
-                #     self.ncfile.setncattr(attribute, value)
-                # else:
-                self.ncfile.setncattr(attribute, value)
+            if attribute not in existing and not is_empty(value):
+                attributes_to_write[attribute] = value
+        # Write all global attributes in one call
+        self.ncfile.setncatts(attributes_to_write)
 
     def close(self):
         # Close the file
         self.ncfile.close()
 
 
-def create_netcdf(pc_df, wavelength_df, variable_mapping, output_filepath, global_attributes, cf_crs, chunk_size):
+def create_netcdf(pc_df, wavelength_df, variable_mapping, output_filepath, global_attributes, cf_crs, chunk_size, netcdf_format='NETCDF4', compression='zlib', workers=1):
     '''
     pc_df : pandas dataframe with columns including latitude, longitude, z
+            A mapping of column names to 1D NumPy arrays can be used instead, and is written without going through pandas
     wavelength_df: frequency bands and intensity values. None if not provided.
     global_attributes : python dictionary of global attributes
     output_filepath: where to write the netcdf file
     cf_crs: Python dictionary of the key value pairs for the variable attributes of the CRS variable.
     variable_mapping: Python dictionary containing the variable names and attributes
-    chunk_size: Chunk size to divide data into along the point dimension
+    chunk_size: Chunk size to divide the 2D intensity data into along the point dimension. None to use the default
+    netcdf_format: Format of the NetCDF file, see netcdf_formats. Only NETCDF4 and NETCDF4_CLASSIC are compressed
+    compression: Compression method for the data variables, see compression_levels. Falls back to zlib if not available
+    workers: number of files being converted at the same time, which share the memory available for building files in memory
     '''
     # TODO: Line by line chunking required, test file is 32 Gb
-    netcdf = NetCDF(output_filepath)
+    # Small files are built in memory rather than with many small writes to disk
+    netcdf = NetCDF(output_filepath, netcdf_format, diskless=fits_in_memory(pc_df, wavelength_df, variable_mapping, workers), compression=compression)
+    # Global attributes are written first, so that the file is not switched back into define mode after data are written
+    netcdf.assign_global_attributes(global_attributes)
     netcdf.write_coordinate_variables(pc_df,wavelength_df,variable_mapping)
     if cf_crs:
         netcdf.define_grid_mapping(cf_crs)
-    netcdf.write_1d_data(pc_df, variable_mapping, chunk_size)
+    netcdf.write_1d_data(pc_df, variable_mapping)
     if wavelength_df is not None and not wavelength_df.empty:
         netcdf.write_2d_data(wavelength_df, variable_mapping, chunk_size)
-    netcdf.assign_global_attributes(global_attributes)
     netcdf.close()
@@ -0,0 +1,12 @@
+'''
+Keys for caching what is parsed from files
+Kept free of heavy imports so that any module can use it
+'''
+import os
+
+def cache_key(filepath):
+    '''
+    Path and modification time of a file, so that cached parses are refreshed when the file changes
+    '''
+    filepath = os.path.abspath(filepath)
+    return filepath, os.stat(filepath).st_mtime_ns
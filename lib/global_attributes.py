@@ -1,14 +1,20 @@
 import json
 import os
 import yaml
-import toml
+try:
+    import tomllib
+except ImportError:
+    # Python < 3.11
+    import tomli as tomllib
+from functools import lru_cache
 import numpy as np
-from lib.utils import validate_time_format
-from datetime import datetime, timezone
+from lib.utils import validate_time_format, is_empty
+from lib.file_cache import cache_key
+import time
 
 
 # Attributes derived during the code that the user does not need to provide
-derived_attributes = [
+derived_attributes = frozenset([
     'date_created',
     'history',
     'geospatial_lat_min',
@@ -17,7 +23,7 @@ derived_attributes = [
     'geospatial_lon_max',
     'Conventions',
     'featureType'
-]
+])
 
 # Required attrbutes
 required_attributes = [
@@ -44,17 +50,120 @@ required_attributes = [
     'license',
     'featureType'
 ]
+required_attribute_set = frozenset(required_attributes)
 
 # Attributes that should have float values
-float_attributes = [
+float_attributes = frozenset([
     'geospatial_lat_min',
     'geospatial_lat_max',
     'geospatial_lon_min',
     'geospatial_lon_max',
     'geospatial_vertical_min',
     'geospatial_vertical_max'
+])
+
+# Attributes that must be in the format YYYY-MM-DD or YYYY-MM-DDTHH:MM:SSZ
+time_attributes = [
+    'time_coverage_start',
+    'time_coverage_end',
+    'date_created'
 ]
 
+# Inclusive (min, max) limits of the attributes describing the geospatial bounds
+coordinate_limits = {
+    'geospatial_lat_min': (-90, 90),
+    'geospatial_lat_max': (-90, 90),
+    'geospatial_lon_min': (-180, 180),
+    'geospatial_lon_max': (-180, 180)
+}
+
+# The same timestamps are often checked again for each file converted in a process
+_cached_validate_time_format = lru_cache(maxsize=256)(validate_time_format)
+
+def _validate_time(attribute, value):
+    '''
+    Error message if the value is not in the format YYYY-MM-DD or YYYY-MM-DDTHH:MM:SSZ, otherwise None
+    '''
+    if not _cached_validate_time_format(value):
+        return f'{attribute} must be in the format YYYY-MM-DD or YYYY-MM-DDTHH:MM:SSZ'
+
+def _limits_validator(lower, upper):
+    '''
+    Validator giving an error message if the value is not a number between lower and upper inclusive
+    '''
+    def validate(attribute, value):
+        try:
+            if not lower <= float(value) <= upper:
+                return f'{attribute} must be between {lower} and {upper} inclusive'
+        except (TypeError, ValueError):
+            return f'{attribute} must be a number'
+    return validate
+
+# (attribute, function to check its value) in the order they are checked, so that check(fail_fast=True)
+# finds the most common errors first: timestamps, then the geospatial bounds
+validators = [(attribute, _validate_time) for attribute in time_attributes]
+validators += [(attribute, _limits_validator(*limits)) for attribute, limits in coordinate_limits.items()]
+validated_attributes = frozenset(attribute for attribute, _ in validators)
+
+# (lower, upper, type to compare them as) for pairs of attributes where lower must not be greater than upper
+# Bounds are compared as numbers, comparing strings would misorder negative values
+orderings = [
+    ('time_coverage_start', 'time_coverage_end', str),
+    ('geospatial_lat_min', 'geospatial_lat_max', float),
+    ('geospatial_lon_min', 'geospatial_lon_max', float)
+]
+
+# Second and formatted string of the last timestamp, see current_timestamp
+_last_timestamp = [None, '']
+
+def current_timestamp():
+    '''
+    Current UTC time in the format YYYY-MM-DDTHH:MM:SSZ
+    Only formatted once per second, as many files can be created within the same second
+    '''
+    now = int(time.time())
+    if now != _last_timestamp[0]:
+        _last_timestamp[:] = [now, time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime(now))]
+    return _last_timestamp[1]
+
+try:
+    # libyaml's C loader is much faster, when PyYAML was built with it
+    from yaml import CSafeLoader as SafeLoader
+except ImportError:
+    from yaml import SafeLoader
+
+
+@lru_cache(maxsize=32)
+def _parse_yaml_file(filepath, mtime_ns):
+    '''
+    Global attributes in a YAML file, cached per file and modification time
+    '''
+    with open(filepath, 'r') as file:
+        data = yaml.load(file, Loader=SafeLoader)
+    return {key: value.get('value', None) for key, value in data.items() if value.get('value')}
+
+def _flatten(nested, flat_dict):
+    '''
+    Add the values in a nested dictionary to flat_dict, ignoring parent keys
+    '''
+    for key, value in nested.items():
+        if isinstance(value, dict):
+            _flatten(value, flat_dict)
+        else:
+            flat_dict[key] = value
+    return flat_dict
+
+@lru_cache(maxsize=32)
+def _parse_toml_file(filepath, mtime_ns):
+    '''
+    Global attributes in a TOML file, cached per file and modification time
+    '''
+    # Open and load the TOML file
+    with open(filepath, 'rb') as f:
+        toml_data = tomllib.load(f)
+
+    # Flatten the TOML data into a dictionary, ignoring parent keys
+    return _flatten(toml_data, {})
 
 class GlobalAttributes:
 
@@ -77,32 +186,13 @@ class GlobalAttributes:
 
     def _read_from_yaml_file(self, filepath):
         """Read global attributes from a YAML file."""
-        with open(filepath, 'r') as file:
-            data = yaml.safe_load(file)
-        attributes = {key: value.get('value', None) for key, value in data.items() if value.get('value')}
-        return attributes
+        # A copy is returned as the attributes are modified later on
+        return dict(_parse_yaml_file(*cache_key(filepath)))
 
     def _read_from_toml_file(self, filepath, sep='_'):
         """Read global attributes from a TOML file."""
-        # Open and load the TOML file
-        with open(filepath, 'r') as f:
-            toml_data = toml.load(f)
-
-        # Flatten the TOML data into a dictionary, ignoring parent keys
-        flat_dict = {}
-        stack = [toml_data]
-
-        while stack:
-            current_dict = stack.pop()
-            for key, value in current_dict.items():
-                if isinstance(value, dict):
-                    # If it's a nested dictionary, add its values to the stack
-                    stack.append(value)
-                else:
-                    # If it's not a dictionary, add the value to the flat_dict
-                    flat_dict[key] = value
-
-        return flat_dict
+        # A copy is returned as the attributes are modified later on
+        return dict(_parse_toml_file(*cache_key(filepath)))
 
     def _read_from_json_string(self, json_string):
         """Parse JSON string."""
@@ -120,18 +210,27 @@ class GlobalAttributes:
         errors = []
         warnings = []
 
-        # Iterate through the dictionary
+        # Convert the float attributes in a single cast
+        float_keys = [key for key in self.dict if key in float_attributes]
+        float_values = [self.dict[key] for key in float_keys]
+        try:
+            # NumPy would convert None to NaN without an error
+            if any(value is None for value in float_values):
+                raise ValueError
+            self.dict.update(zip(float_keys, np.asarray(float_values, dtype=np.float64).tolist()))
+        except (TypeError, ValueError):
+            # Convert one at a time to find the values that cannot be converted
+            for key in float_keys:
+                try:
+                    self.dict[key] = float(self.dict[key])
+                except (TypeError, ValueError):
+                    # Append to errors list if conversion fails
+                    errors.append(f"Error converting {key} to float.")
+
+        # Convert all other values to string
         for key, value in self.dict.items():
-            try:
-                if key in float_attributes:
-                    # Convert value to float
-                    self.dict[key] = float(value)
-                else:
-                    # Convert value to string
-                    self.dict[key] = str(value)
-            except ValueError:
-                # Append to errors list if conversion fails
-                errors.append(f"Error converting {key} to {'float' if key in float_attributes else 'string'}.")
+            if key not in float_attributes:
+                self.dict[key] = str(value)
 
         return errors, warnings
 
@@ -141,24 +240,30 @@ class GlobalAttributes:
         Attributes will only be written if the user has not provided them
         '''
         # Derive bounding box for coordinates based on data
-        self.dict.setdefault('geospatial_lat_min', ply_df['latitude'].min())
-        self.dict.setdefault('geospatial_lat_max', ply_df['latitude'].max())
-        self.dict.setdefault('geospatial_lon_min', ply_df['longitude'].min())
-        self.dict.setdefault('geospatial_lon_max', ply_df['longitude'].max())
-        self.dict.setdefault('geospatial_vertical_min', ply_df['Z'].min())
-        self.dict.setdefault('geospatial_vertical_max', ply_df['Z'].max())
-
-        # Get the current timestamp in ISO8601 format
-        current_timestamp = datetime.now(timezone.utc).strftime('%Y-%m-%dT%H:%M:%SZ')
-        self.dict.setdefault('date_created', current_timestamp)
-        self.dict.setdefault('history', f'{current_timestamp}: File created using the netCDF4 library in Python.')
+        # Minimum and maximum of all three coordinates are computed in one reduction each
+        coords = ply_df[['latitude', 'longitude', 'Z']].to_numpy(dtype=np.float64)
+        mins = np.nanmin(coords, axis=0)
+        maxs = np.nanmax(coords, axis=0)
+        self.dict.setdefault('geospatial_lat_min', float(mins[0]))
+        self.dict.setdefault('geospatial_lat_max', float(maxs[0]))
+        self.dict.setdefault('geospatial_lon_min', float(mins[1]))
+        self.dict.setdefault('geospatial_lon_max', float(maxs[1]))
+        self.dict.setdefault('geospatial_vertical_min', float(mins[2]))
+        self.dict.setdefault('geospatial_vertical_max', float(maxs[2]))
+
+        # Get the current timestamp in ISO8601 format, only if it is needed
+        if 'date_created' not in self.dict or 'history' not in self.dict:
+            timestamp = current_timestamp()
+            self.dict.setdefault('date_created', timestamp)
+            self.dict.setdefault('history', f'{timestamp}: File created using the netCDF4 library in Python.')
 
         self.dict.setdefault('Conventions', 'CF-1.8, ACDD-1.3')
         self.dict.setdefault('featureType', 'point')
 
-    def check(self):
+    def check(self, fail_fast=False):
         '''
         Check the values that the user has provided for the global attributes
+        fail_fast: return as soon as one error is found, rather than collecting all of them
         '''
         # List of errors that will be appended to throughout this function.
         # If there are any errors, no CF-NetCDF file will be created
@@ -168,50 +273,52 @@ class GlobalAttributes:
         # Warnings will be flagged to the user but this alone will not stop a CF-NetCDF file from being created
         warnings = []
 
-        for required_attribute in required_attributes:
-            if required_attribute not in self.dict.keys():
-                errors.append(f'"{required_attribute}" is a required global attribute. Please provide a value')
-        if len(errors) > 0:
+        missing_attributes = required_attribute_set - self.dict.keys()
+        if missing_attributes:
+            # Reported in the order of required_attributes
+            for required_attribute in required_attributes:
+                if required_attribute in missing_attributes:
+                    errors.append(f'"{required_attribute}" is a required global attribute. Please provide a value')
+                    if fail_fast:
+                        break
             return errors, warnings
 
-        for attribute, value in self.dict.items():
-
-            if value in ['nan', np.nan, None, '']:
-                if attribute in required_attributes and attribute not in derived_attributes:
-                    errors.append(f'"{attribute}" is a required global attribute. Please provide a value')
-                else:
-                    pass
-            else:
-                if attribute in ['time_coverage_start', 'time_coverage_end', 'date_created']:
-                    if validate_time_format(value) == False:
-                        errors.append(f'{attribute} must be in the format YYYY-MM-DD or YYYY-MM-DDTHH:MM:SSZ')
-
-                if attribute in ['geospatial_lat_min', 'geospatial_lat_max']:
-                    if -90 <= float(value) <= 90:
-                        pass
-                    else:
-                        errors.append(f'{attribute} must be between -90 and 90 inclusive')
-
-                if attribute in ['geospatial_lon_min', 'geospatial_lon_max']:
-                    if -180 <= float(value) <= 180:
-                        pass
-                    else:
-                        errors.append(f'{attribute} must be between -180 and 180 inclusive')
-
-        geospatial_lat_min = self.dict['geospatial_lat_min']
-        geospatial_lat_max = self.dict['geospatial_lat_max']
-        geospatial_lon_min = self.dict['geospatial_lon_min']
-        geospatial_lon_max = self.dict['geospatial_lon_max']
-        time_coverage_start = self.dict['time_coverage_start']
-        time_coverage_end = self.dict['time_coverage_end']
-
-        if geospatial_lat_min > geospatial_lat_max:
-            errors.append('geospatial_lat_max must be greater than or equal to geospatial_lat_min')
-
-        if geospatial_lon_min > geospatial_lon_max:
-            errors.append('geospatial_lon_max must be greater than or equal to geospatial_lon_min')
-
-        if time_coverage_start > time_coverage_end:
-            errors.append('time_coverage_end must be greater than or equal to time_coverage_start')
+        def required_error(attribute):
+            if attribute in required_attribute_set and attribute not in derived_attributes:
+                return f'"{attribute}" is a required global attribute. Please provide a value'
+
+        # Attributes with a required format, in the order of validators
+        for attribute, validator in validators:
+            value = self.dict.get(attribute)
+            error = required_error(attribute) if is_empty(value) else validator(attribute, value)
+            if error:
+                errors.append(error)
+                if fail_fast:
+                    return errors, warnings
+
+        # Other required attributes must have a value
+        for attribute in required_attributes:
+            if attribute not in validated_attributes and is_empty(self.dict[attribute]):
+                error = required_error(attribute)
+                if error:
+                    errors.append(error)
+                    if fail_fast:
+                        return errors, warnings
+
+        # Each pair is only compared when it is reached
+        # Missing or invalid values are already reported above
+        for lower, upper, as_type in orderings:
+            lower_value = self.dict.get(lower)
+            upper_value = self.dict.get(upper)
+            if is_empty(lower_value) or is_empty(upper_value):
+                continue
+            try:
+                failed = as_type(lower_value) > as_type(upper_value)
+            except (TypeError, ValueError):
+                continue
+            if failed:
+                errors.append(f'{upper} must be greater than or equal to {lower}')
+                if fail_fast:
+                    return errors, warnings
 
         return errors, warnings
\ No newline at end of file
@@ -1,9 +1,11 @@
 import os
 import struct
-import sys
+from functools import lru_cache
 
 import numpy as np
 
+from lib import hyspex_numba
+from lib.file_cache import cache_key
 
 class HyspexRad:
     """
@@ -37,17 +39,54 @@ class HyspexRad:
         """
         assert len(line_index) == len(sample_index)
 
-        CN = self.img_bil[line_index, :, sample_index].T - self.BG[:, sample_index]
-        CN /= self.RE[:, sample_index]
-        CN /= self.denominator[:, sample_index]
+        # Visit the pixels in file order, line by line, so each part of the memmap is read once,
+        # and put the spectra back in the order they were asked for at the end
+        line_index = np.asarray(line_index, dtype=np.intp)
+        sample_index = np.asarray(sample_index, dtype=np.intp)
+        order = np.lexsort((sample_index, line_index))
+        line_index = line_index[order]
+        sample_index = sample_index[order]
+
+        # Each pixel is calibrated in parallel without temporary arrays when numba is installed
+        if hyspex_numba.HAS_NUMBA:
+            CN = hyspex_numba.calibrate(
+                self.img_bil, self.BG, self.inv_cal, line_index, sample_index, self.dtype
+            )
+        else:
+            # Fancy indexing gives (K, Nb), so the (Nb, K) parameters are transposed to match
+            # and the two divisions are one multiplication by the precomputed reciprocal
+            CN = self.img_bil[line_index, :, sample_index] - self.BG[:, sample_index].T
+            CN *= self.inv_cal[:, sample_index].T
+
+        calibrated = np.empty_like(CN)
+        calibrated[order] = CN
+        return calibrated
+
+    def calibrate_line(self, line):
+        """
+        Calibrate every sample of one line.
+
+        Returns the spectra with shape (Ns, Nb), the same as
+        calibrate_spectrum([line] * Ns, range(Ns)). The line is read as one
+        contiguous (Nb, Ns) block of the bil file, which is the layout of the
+        calibration parameters, so no pixels are gathered.
+        """
+        # The bands are calibrated in parallel without temporary arrays when numba is installed
+        if hyspex_numba.HAS_NUMBA:
+            return hyspex_numba.calibrate_line(
+                self.img_bil, self.BG, self.inv_cal, line, self.dtype
+            )
+
+        CN = self.img_bil[line] - self.BG
+        CN *= self.inv_cal
         return CN.T
 
     def _prepare_parameters(self):
         # Extract data needed for the calibration
         # 1 if the data has been real time calibrated
         self.CALIBAVAILIBLE = bool(self.bin_hdr["CalibAvailible"])
-        self.BG = self.bin_hdr["BGnp"].astype(self.dtype)  # Background
-        self.RE = self.bin_hdr["REnp"].astype(self.dtype)  # Response matrix
+        self.BG = self.bin_hdr["BGnp"].astype(self.dtype, copy=False)  # Background
+        self.RE = self.bin_hdr["REnp"].astype(self.dtype, copy=False)  # Response matrix
 
         # Quantum efficiency of center pixel
         QE = np.array(self.bin_hdr["QE"])
@@ -78,8 +117,11 @@ class HyspexRad:
 
         scalingfactor = (pixelarea * integrationtime_s * aperture_area * SF) / (h * c)
 
-        self.denominator = QE * BW * WL * scalingfactor
-        self.denominator = np.tile(self.denominator, [self.Ns, 1]).T.astype(self.dtype)
+        # One value per band, shape (Nb,), broadcast over the samples when needed
+        self.denominator = (QE * BW * WL * scalingfactor).astype(self.dtype, copy=False)
+
+        # Reciprocal of the response times the denominator, so calibrating is a single multiplication
+        self.inv_cal = (1.0 / (self.RE * self.denominator[:, None])).astype(self.dtype, copy=False)
 
 
 # -----------------------------------------------------------------------------
@@ -93,8 +135,8 @@ def import_hyspex(hyspex_file, mode="r", reshape2bip=False):
     ss = os.path.splitext(hyspex_file)
     hyspex_hdr_file = ss[0] + ".hdr"
 
-    # Get hdr
-    hdr = read_envi_header(hyspex_hdr_file)
+    # Get hdr, a copy of the cached parse as it may be modified by the caller
+    hdr = dict(_cached_envi_header(*cache_key(hyspex_hdr_file)))
     dtype = np.dtype(envi_to_dtype[hdr["data type"]])
     offset = int(hdr["header offset"])
     Nl, Ns, Nb = (
@@ -116,9 +158,7 @@ def import_hyspex(hyspex_file, mode="r", reshape2bip=False):
     # parse the binary header
     bin_hdr = {}
     if offset > 0:
-        with open(hyspex_file, "rb") as fd:
-            data = fd.read(offset)
-        bin_hdr = parse_hyspex_bin_header(data)
+        bin_hdr = dict(_cached_bin_header(*cache_key(hyspex_file), offset))
     # Get spectral data
     if hdr["interleave"].lower() == "bil":
         try:
@@ -210,12 +250,12 @@ def read_envi_header(file, support_nonlowercase_params=True):
               at beginning of first line).'
             f.close()
             raise FileNotAnEnviHeader(msg)
-    lines = f.readlines()
+    # Iterate over the lines once, taking the continuation lines of {...} values from the same iterator
+    lines = iter(f.readlines())
     f.close()
     dict = {}
     try:
-        while lines:
-            line = lines.pop(0)
+        for line in lines:
             if line.find("=") == -1:
                 continue
             if line[0] == ";":
@@ -230,7 +270,7 @@ def read_envi_header(file, support_nonlowercase_params=True):
             if val and val[0] == "{":
                 str = val.strip()
                 while str[-1] != "}":
-                    line = lines.pop(0)
+                    line = next(lines)
                     if line[0] == ";":
                         continue
 
@@ -257,155 +297,142 @@ def read_envi_header(file, support_nonlowercase_params=True):
         raise EnviHeaderParsingError()
 
 
-def parse_bytearray(arr, fmt, bptr, special=None):
-    """
-    Parse a byte package.
-    Support striping '\x00' from strings.
-    """
-    size = struct.Struct(fmt).size
-    res = struct.unpack(fmt, arr[bptr : bptr + size])
-    if len(res) == 1:
-        res = res[0]
-    bptr += size  # Increment the byte ptr
-    if special:
-        res = res.decode("latin1").rstrip("\x00")
-    return res, bptr
-
+# Fixed size part of the hyspex binary header: field names and struct formats in file order.
+# Byte string fields are decoded and stripped of their "\x00" padding.
+hyspex_bin_header_fields = [
+    ("hyspex_word", "8s"),
+    ("size", "i"),
+    ("serial_number", "I"),
+    ("configfile", "200s"),
+    ("settingfile", "120s"),
+    ("scaling_factor", "d"),
+    ("electronics", "I"),
+    ("comsettings_electronics", "I"),
+    ("comport_electronics", "56s"),
+    ("fanspeed", "I"),
+    ("backtemperature", "I"),
+    ("comport", "64s"),
+    ("detectstring", "200s"),
+    ("sensor", "200s"),
+    ("framegrabber", "200s"),
+    ("ID", "200s"),
+    ("supplier", "200s"),
+    ("left_gain", "32s"),
+    ("right_gain", "32s"),
+    ("comment", "200s"),
+    ("backgroundfile", "200s"),
+    ("RecordHD", "c"),
+    ("UknownPtr1", "I"),
+    ("serverindex", "I"),
+    ("comsettings", "I"),
+    ("number_of_background", "I"),
+    ("spectral_size", "I"),
+    ("spatial_size", "I"),
+    ("binning", "I"),
+    ("detected", "I"),
+    ("integration_time", "I"),
+    ("frame_period", "I"),
+    ("default_R", "I"),
+    ("default_G", "I"),
+    ("default_B", "I"),
+    ("bitshift", "I"),
+    ("temperature_offset", "I"),
+    ("shutter", "I"),
+    ("background_present", "I"),
+    ("power", "I"),
+    ("current", "I"),
+    ("bias", "I"),
+    ("bandwidth", "I"),
+    ("vin", "I"),
+    ("vref", "I"),
+    ("sensor_vin", "I"),
+    ("sensor_vref", "I"),
+    ("cooling_temperature", "I"),
+    ("window_start", "I"),
+    ("window_stop", "I"),
+    ("readout_time", "I"),
+    ("p", "I"),
+    ("i", "I"),
+    ("d", "I"),
+    ("numberofframes", "I"),
+    ("nobp", "I"),
+    ("dw", "I"),
+    ("EQ", "I"),
+    ("lens", "I"),
+    ("FOVexp", "I"),
+    ("ScanningMode", "I"),
+    ("CalibAvailible", "I"),
+    ("NumberOfAvg", "I"),
+    ("SF", "d"),
+    ("aperture_size", "d"),
+    ("pixelsize_x", "d"),
+    ("pixelsize_y", "d"),
+    ("temperature", "d"),
+    ("max_framerate", "d"),
+    ("spectralCalibPOINTER", "I"),
+    ("REPOINTER", "I"),
+    ("QEPOINTER", "I"),
+    ("backgroundPOINTER", "I"),
+    ("badPixelsPOINTER", "I"),
+    ("imageFormat", "I"),
+]
+hyspex_bin_header_struct = struct.Struct(
+    "<" + "".join(fmt for _, fmt in hyspex_bin_header_fields)
+)
 
 def parse_hyspex_bin_header(data):
     """
     Parse the hyspex binary header.
+    The fixed size fields are unpacked in one call and the calibration
+    arrays are read with np.frombuffer, without copying them.
     """
-    bptr = 0
-    hyspex_word, bptr = parse_bytearray(data, "<8s", bptr, special="strip_string")
-    if hyspex_word != "HYSPEX":
-        raise IOError("Uknown binary file format")
-        sys.exit(0)
+    values = hyspex_bin_header_struct.unpack_from(data, 0)
     bin_hdr = {}
-    bin_hdr["size"], bptr = parse_bytearray(data, "<i", bptr)
-    bin_hdr["serial_number"], bptr = parse_bytearray(data, "<I", bptr)
-    bin_hdr["configfile"], bptr = parse_bytearray(
-        data, "<200s", bptr, special="strip_string"
-    )
-    bin_hdr["settingfile"], bptr = parse_bytearray(
-        data, "<120s", bptr, special="strip_string"
-    )
-    bin_hdr["scaling_factor"], bptr = parse_bytearray(data, "<d", bptr)
-    bin_hdr["electronics"], bptr = parse_bytearray(data, "<I", bptr)
-    bin_hdr["comsettings_electronics"], bptr = parse_bytearray(data, "<I", bptr)
-    bin_hdr["comport_electronics"], bptr = parse_bytearray(
-        data, "<56s", bptr, special="strip_string"
-    )
-    bin_hdr["fanspeed"], bptr = parse_bytearray(data, "<I", bptr)
-    bin_hdr["backtemperature"], bptr = parse_bytearray(data, "<I", bptr)
-    bin_hdr["comport"], bptr = parse_bytearray(
-        data, "<64s", bptr, special="strip_string"
-    )
-    bin_hdr["detectstring"], bptr = parse_bytearray(
-        data, "<200s", bptr, special="strip_string"
-    )
-    bin_hdr["sensor"], bptr = parse_bytearray(
-        data, "<200s", bptr, special="strip_string"
-    )
-    bin_hdr["framegrabber"], bptr = parse_bytearray(
-        data, "<200s", bptr, special="strip_string"
-    )
-    bin_hdr["ID"], bptr = parse_bytearray(data, "<200s", bptr, special="strip_string")
-    bin_hdr["supplier"], bptr = parse_bytearray(
-        data, "<200s", bptr, special="strip_string"
-    )
-    bin_hdr["left_gain"], bptr = parse_bytearray(
-        data, "<32s", bptr, special="strip_string"
-    )
-    bin_hdr["right_gain"], bptr = parse_bytearray(
-        data, "<32s", bptr, special="strip_string"
-    )
-    bin_hdr["comment"], bptr = parse_bytearray(
-        data, "<200s", bptr, special="strip_string"
-    )
-    bin_hdr["backgroundfile"], bptr = parse_bytearray(
-        data, "<200s", bptr, special="strip_string"
-    )
-    bin_hdr["RecordHD"], bptr = parse_bytearray(
-        data, "<c", bptr, special="strip_string"
-    )
-    bin_hdr["UknownPtr1"], bptr = parse_bytearray(data, "<I", bptr)
-    bin_hdr["serverindex"], bptr = parse_bytearray(data, "<I", bptr)
-    bin_hdr["comsettings"], bptr = parse_bytearray(data, "<I", bptr)
-    bin_hdr["number_of_background"], bptr = parse_bytearray(data, "<I", bptr)
-    bin_hdr["spectral_size"], bptr = parse_bytearray(data, "<I", bptr)
-    bin_hdr["spatial_size"], bptr = parse_bytearray(data, "<I", bptr)
-    bin_hdr["binning"], bptr = parse_bytearray(data, "<I", bptr)
-    bin_hdr["detected"], bptr = parse_bytearray(data, "<I", bptr)
-    bin_hdr["integration_time"], bptr = parse_bytearray(data, "<I", bptr)
-    bin_hdr["frame_period"], bptr = parse_bytearray(data, "<I", bptr)
-    bin_hdr["default_R"], bptr = parse_bytearray(data, "<I", bptr)
-    bin_hdr["default_G"], bptr = parse_bytearray(data, "<I", bptr)
-    bin_hdr["default_B"], bptr = parse_bytearray(data, "<I", bptr)
-    bin_hdr["bitshift"], bptr = parse_bytearray(data, "<I", bptr)
-    bin_hdr["temperature_offset"], bptr = parse_bytearray(data, "<I", bptr)
-    bin_hdr["shutter"], bptr = parse_bytearray(data, "<I", bptr)
-    bin_hdr["background_present"], bptr = parse_bytearray(data, "<I", bptr)
-    bin_hdr["power"], bptr = parse_bytearray(data, "<I", bptr)
-    bin_hdr["current"], bptr = parse_bytearray(data, "<I", bptr)
-    bin_hdr["bias"], bptr = parse_bytearray(data, "<I", bptr)
-    bin_hdr["bandwidth"], bptr = parse_bytearray(data, "<I", bptr)
-    bin_hdr["vin"], bptr = parse_bytearray(data, "<I", bptr)
-    bin_hdr["vref"], bptr = parse_bytearray(data, "<I", bptr)
-    bin_hdr["sensor_vin"], bptr = parse_bytearray(data, "<I", bptr)
-    bin_hdr["sensor_vref"], bptr = parse_bytearray(data, "<I", bptr)
-    bin_hdr["cooling_temperature"], bptr = parse_bytearray(data, "<I", bptr)
-    bin_hdr["window_start"], bptr = parse_bytearray(data, "<I", bptr)
-    bin_hdr["window_stop"], bptr = parse_bytearray(data, "<I", bptr)
-    bin_hdr["readout_time"], bptr = parse_bytearray(data, "<I", bptr)
-    bin_hdr["p"], bptr = parse_bytearray(data, "<I", bptr)
-    bin_hdr["i"], bptr = parse_bytearray(data, "<I", bptr)
-    bin_hdr["d"], bptr = parse_bytearray(data, "<I", bptr)
-    bin_hdr["numberofframes"], bptr = parse_bytearray(data, "<I", bptr)
-    bin_hdr["nobp"], bptr = parse_bytearray(data, "<I", bptr)
-    bin_hdr["dw"], bptr = parse_bytearray(data, "<I", bptr)
-    bin_hdr["EQ"], bptr = parse_bytearray(data, "<I", bptr)
-    bin_hdr["lens"], bptr = parse_bytearray(data, "<I", bptr)
-    bin_hdr["FOVexp"], bptr = parse_bytearray(data, "<I", bptr)
-    bin_hdr["ScanningMode"], bptr = parse_bytearray(data, "<I", bptr)
-    bin_hdr["CalibAvailible"], bptr = parse_bytearray(data, "<I", bptr)
-    bin_hdr["NumberOfAvg"], bptr = parse_bytearray(data, "<I", bptr)
-    bin_hdr["SF"], bptr = parse_bytearray(data, "<d", bptr)
-    bin_hdr["aperture_size"], bptr = parse_bytearray(data, "<d", bptr)
-    bin_hdr["pixelsize_x"], bptr = parse_bytearray(data, "<d", bptr)
-    bin_hdr["pixelsize_y"], bptr = parse_bytearray(data, "<d", bptr)
-    bin_hdr["temperature"], bptr = parse_bytearray(data, "<d", bptr)
-    bin_hdr["max_framerate"], bptr = parse_bytearray(data, "<d", bptr)
-    bin_hdr["spectralCalibPOINTER"], bptr = parse_bytearray(data, "<I", bptr)
-    bin_hdr["REPOINTER"], bptr = parse_bytearray(data, "<I", bptr)
-    bin_hdr["QEPOINTER"], bptr = parse_bytearray(data, "<I", bptr)
-    bin_hdr["backgroundPOINTER"], bptr = parse_bytearray(data, "<I", bptr)
-    bin_hdr["badPixelsPOINTER"], bptr = parse_bytearray(data, "<I", bptr)
-    bin_hdr["imageFormat"], bptr = parse_bytearray(data, "<I", bptr)
-    bin_hdr["spectralCalib"], bptr = parse_bytearray(
-        data, "<%dd" % bin_hdr["spectral_size"], bptr
-    )
-    bin_hdr["QE"], bptr = parse_bytearray(data, "<%dd" % bin_hdr["spectral_size"], bptr)
-    bin_hdr["RE"], bptr = parse_bytearray(
-        data, "<%dd" % (bin_hdr["spectral_size"] * bin_hdr["spatial_size"]), bptr
-    )
-    bin_hdr["backgroundBefore"], bptr = parse_bytearray(
-        data, "<%dd" % (bin_hdr["spectral_size"] * bin_hdr["spatial_size"]), bptr
-    )
-    bin_hdr["badPixels"], bptr = parse_bytearray(data, "<%dI" % bin_hdr["nobp"], bptr)
-    bin_hdr["wlnp"] = np.array(bin_hdr["spectralCalib"]).reshape(
-        bin_hdr["spectral_size"]
-    )
-    bin_hdr["QEnp"] = np.array(bin_hdr["QE"]).reshape(bin_hdr["spectral_size"])
-    bin_hdr["REnp"] = np.array(bin_hdr["RE"]).reshape(
-        bin_hdr["spectral_size"], bin_hdr["spatial_size"]
-    )
-    bin_hdr["BGnp"] = np.array(bin_hdr["backgroundBefore"]).reshape(
-        bin_hdr["spectral_size"], bin_hdr["spatial_size"]
-    )
+    for (key, _), value in zip(hyspex_bin_header_fields, values):
+        if isinstance(value, bytes):
+            value = value.decode("latin1").rstrip("\x00")
+        bin_hdr[key] = value
+    if bin_hdr.pop("hyspex_word") != "HYSPEX":
+        raise IOError("Uknown binary file format")
+
+    spectral_size = bin_hdr["spectral_size"]
+    spatial_size = bin_hdr["spatial_size"]
+    bptr = hyspex_bin_header_struct.size
+    for key, dtype, count in [
+        ("spectralCalib", "<f8", spectral_size),
+        ("QE", "<f8", spectral_size),
+        ("RE", "<f8", spectral_size * spatial_size),
+        ("backgroundBefore", "<f8", spectral_size * spatial_size),
+        ("badPixels", "<u4", bin_hdr["nobp"]),
+    ]:
+        bin_hdr[key] = np.frombuffer(data, dtype=dtype, count=count, offset=bptr)
+        bptr += bin_hdr[key].nbytes
+
+    bin_hdr["wlnp"] = bin_hdr["spectralCalib"]
+    bin_hdr["QEnp"] = bin_hdr["QE"]
+    bin_hdr["REnp"] = bin_hdr["RE"].reshape(spectral_size, spatial_size)
+    bin_hdr["BGnp"] = bin_hdr["backgroundBefore"].reshape(spectral_size, spatial_size)
     return bin_hdr
 
 
+@lru_cache(maxsize=16)
+def _cached_envi_header(filepath, mtime_ns):
+    """
+    ENVI header, cached per file and modification time.
+    """
+    return read_envi_header(filepath)
+
+
+@lru_cache(maxsize=16)
+def _cached_bin_header(hyspex_file, mtime_ns, offset):
+    """
+    Hyspex binary header, cached per file, modification time and header size.
+    The arrays are read-only views of the header bytes, so they can be shared.
+    """
+    with open(hyspex_file, "rb") as fd:
+        data = fd.read(offset)
+    return parse_hyspex_bin_header(data)
+
 # ----------------------------------------------------------------------------
 # Usage
 # ----------------------------------------------------------------------------
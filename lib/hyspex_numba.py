@@ -0,0 +1,45 @@
+'''
+Compiled radiance calibration of Hyspex bil data, used by HyspexRad when numba is installed
+'''
+import numpy as np
+
+try:
+    from numba import njit, prange
+    HAS_NUMBA = True
+except ImportError:
+    HAS_NUMBA = False
+
+if HAS_NUMBA:
+    @njit(parallel=True, fastmath=True, cache=True)
+    def _calibrate_kernel(img, BG, inv_cal, lines, samples, out):
+        for k in prange(lines.shape[0]):
+            l = lines[k]
+            s = samples[k]
+            for b in range(img.shape[1]):
+                out[k, b] = (img[l, b, s] - BG[b, s]) * inv_cal[b, s]
+
+    @njit(parallel=True, fastmath=True, cache=True)
+    def _calibrate_line_kernel(img, BG, inv_cal, line, out):
+        for b in prange(img.shape[1]):
+            for s in range(img.shape[2]):
+                out[b, s] = (img[line, b, s] - BG[b, s]) * inv_cal[b, s]
+
+def calibrate(img, BG, inv_cal, line_index, sample_index, dtype=np.float32):
+    '''
+    Calibrated spectra, shape (K, Nb), of the K pixels given by line_index and sample_index
+    img is the (Nl, Nb, Ns) bil data, BG and inv_cal are (Nb, Ns)
+    '''
+    lines = np.asarray(line_index, dtype=np.intp)
+    samples = np.asarray(sample_index, dtype=np.intp)
+    out = np.empty((lines.shape[0], img.shape[1]), dtype=dtype)
+    _calibrate_kernel(img, BG, inv_cal, lines, samples, out)
+    return out
+
+def calibrate_line(img, BG, inv_cal, line, dtype=np.float32):
+    '''
+    Calibrated spectra, shape (Ns, Nb), of every sample of one line
+    The bands are calibrated in parallel, each one reading a contiguous row of the bil line
+    '''
+    out = np.empty((img.shape[1], img.shape[2]), dtype=dtype)
+    _calibrate_line_kernel(img, BG, inv_cal, line, out)
+    return out.T
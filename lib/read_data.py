@@ -4,51 +4,49 @@ import spectral as sp
 from plyfile import PlyData
 from pyproj import Transformer, CRS
 import laspy
-import gc
 #import dask.dataframe as dd
 #import dask.array as da
 import logging
 import os
-import re
+import mmap
+import json
+from functools import lru_cache
 from lib.hyspex_calibration import HyspexRad
+from lib import tmerc
+from lib.variable_mapping import match_columns
+from lib.utils import hdr_lines_pattern, hdr_samples_pattern, hdr_interleave_pattern
 
 
 logger = logging.getLogger(__name__)
 
-def combine_dataframes(dfs):
-    '''
-    Combining a list of dataframes with the same columns into one df
-    '''
-    combined_df = pd.DataFrame()  # Start with an empty DataFrame
-
-    for chunk in dfs:
-        combined_df = pd.concat([combined_df, chunk], ignore_index=True)
-        # Clear the previous chunk from memory
-        del chunk
-        # Force garbage collection
-        gc.collect()
-
-    return combined_df
+def _read_ply_header(plyfile):
+    """
+    Get the lines of the ply file header, before end_header
+    The file is memory mapped so the end of the header is found in one scan without reading the data
+    """
+    with open(plyfile, 'rb') as fd:
+        try:
+            mm = mmap.mmap(fd.fileno(), 0, access=mmap.ACCESS_READ)
+        except ValueError:
+            # Empty files cannot be memory mapped
+            raise IOError("Didn't find end of header. This can't be a valid PLY file.")
+        with mm:
+            end = mm.find(b'\nend_header')
+            if end == -1:
+                raise IOError("Didn't find end of header. This can't be a valid PLY file.")
+            header = mm[:end]
+    return [line.strip() for line in header.decode('utf-8').splitlines()]
 
 def get_ply_comment(plyfile):
     """
     Get the ply file comment string
     """
     #! This will not be neccessary if projection in metadata file
-    with open(plyfile, 'rb') as fd:
-        for line in fd:
-            # Decode the line to a string
-            decoded_line = line.decode('utf-8').strip()
-
-            # Check if the line starts with 'comment'
-            if decoded_line.startswith("comment"):
-                return decoded_line
-
-            # Check if the line indicates the end of the header
-            elif decoded_line.startswith("end_header"):
-                return None
-
-        raise IOError("Didn't find end of header. This can't be a valid PLY file.")
+    for line in _read_ply_header(plyfile):
+        # Check if the line starts with 'comment'
+        if line.startswith("comment"):
+            return line
+    return None
 
 
 def get_cf_crs(ply_filepath=None, proj4str=None):
@@ -86,21 +84,31 @@ def get_cf_crs(ply_filepath=None, proj4str=None):
     return cf_crs, errors, warnings
 
 
+@lru_cache(maxsize=150)
+def _latlon_transformer(cf_crs_json):
+    '''
+    Transformer from the CRS to WGS84 latitude and longitude
+    Building a transformer is slow, so one is kept for each CRS. The CRS is passed as a JSON string so it can be hashed
+    '''
+    crs = CRS.from_cf(json.loads(cf_crs_json))
+    return Transformer.from_crs(crs, CRS.from_epsg(4326), always_xy=True)
+
 def utm_to_latlon(x, y, cf_crs):
 
-    crs = CRS.from_cf(cf_crs)
+    # Convert UTM (x, y) arrays to lat/lon arrays in a single call
+    # Contiguous float64 arrays are passed to PROJ without being copied again
+    x = np.ascontiguousarray(x, dtype=np.float64)
+    y = np.ascontiguousarray(y, dtype=np.float64)
 
-    # Create a Transformer object for UTM to WGS84 conversion
-    transformer = Transformer.from_crs(crs, CRS.from_epsg(4326), always_xy=True)
+    # Transverse Mercator on WGS84 is computed directly, in parallel, when numba is installed
+    if tmerc.HAS_NUMBA and tmerc.is_supported(cf_crs):
+        return tmerc.inverse(x, y, cf_crs)
 
-    # Convert UTM (x, y) arrays to lat/lon arrays
+    # Get the cached Transformer object for UTM to WGS84 conversion
+    transformer = _latlon_transformer(json.dumps(cf_crs, sort_keys=True))
     lon, lat = transformer.transform(x, y)
     return lat, lon
 
-def process_chunk(start, end, data_dict):
-    chunk = {key: value[start:end] for key, value in data_dict.items()}
-    return pd.DataFrame(chunk)
-
 def las_to_df(las_filepath, cf_crs, variable_mapping, xcoord=None, ycoord=None, zcoord=None):
     # Open the LAS file
     las = laspy.read(las_filepath)
@@ -122,52 +130,35 @@ def las_to_df(las_filepath, cf_crs, variable_mapping, xcoord=None, ycoord=None,
     for var in variable_list:
         if var in [dim.name for dim in las.point_format.dimensions]:
             print('adding ',var,' to dict')
-            data_dict[var] = np.array(las[var])  # Ensure conversion to NumPy array
-
-    # Convert the dictionary to a pandas DataFrame
-    # Process in smaller chunks, for example, chunks of 10000 rows
-    chunk_size = 10000000
-    num_rows = len(data_dict['x'])
-
-    # Process each chunk
-    dfs = []
-    print('Processing chunks to df')
-    for i in range(0, num_rows, chunk_size):
-        df_chunk = process_chunk(i, i + chunk_size, data_dict)
-        # If X, Y and Z are equal to lat, lon, altitude
-        if xcoord:
-            df_chunk.rename(columns={'x': xcoord}, inplace=True)
-        if ycoord:
-            df_chunk.rename(columns={'y': ycoord}, inplace=True)
-        if zcoord:
-            df_chunk.rename(columns={'z': zcoord}, inplace=True)
-        dfs.append(df_chunk)
-
-    print('Calculating lat/lon')
-    if not all(col in dfs[0].columns for col in ['latitude', 'longitude']):
-        cf_crs = get_cf_crs()
-        processed_dfs = []
-        for df in dfs:
-            # Calculate latitude and longitude from X and Y and the CRS
-            lat, lon = utm_to_latlon(df['x'].values, df['y'].values, cf_crs)
-            df['latitude'], df['longitude'] = lat, lon
-            processed_dfs.append(df)
-        dfs = processed_dfs
-    else:
-        pass
+            data_dict[var] = np.asarray(las[var])  # Ensure conversion to NumPy array
 
-    print('combining dataframes')
-    combined_df = combine_dataframes(dfs)
+    # Calculate latitude and longitude from X and Y and the CRS, for all points at once
+    # unless X and Y are already latitude and longitude
+    if not {'latitude', 'longitude'} <= {xcoord, ycoord, zcoord}:
+        print('Calculating lat/lon')
+        data_dict['latitude'], data_dict['longitude'] = utm_to_latlon(data_dict['x'], data_dict['y'], cf_crs)
 
-    return combined_df
+    # Convert the dictionary to a pandas DataFrame in one go, renaming X, Y and Z
+    # if they are equal to lat, lon, altitude
+    coordinate_names = {'x': xcoord, 'y': ycoord, 'z': zcoord}
+    print('Creating dataframe')
+    df = pd.DataFrame({coordinate_names.get(key) or key: value for key, value in data_dict.items()}, copy=False)
 
-def list_variables_in_ply(ply_filepath):
-    # Read the PLY file
-    with open(ply_filepath, 'rb') as file:
-        ply_data = PlyData.read(file)
+    return df
 
-    # Extract the column names dynamically from the PLY header
-    column_names = [prop.name for prop in ply_data['vertex'].properties]
+def list_variables_in_ply(ply_filepath):
+    # Extract the column names of the vertex element from the PLY header, without reading the data
+    # Properties are listed as "property <type> <name>" or "property list <count type> <type> <name>"
+    column_names = []
+    in_vertex = False
+    for line in _read_ply_header(ply_filepath):
+        words = line.split()
+        if not words:
+            continue
+        if words[0] == 'element':
+            in_vertex = words[1:2] == ['vertex']
+        elif words[0] == 'property' and in_vertex:
+            column_names.append(words[-1])
 
     return column_names
 
@@ -177,53 +168,25 @@ def ply_to_df(ply_filepath, cf_crs, variable_mapping, xcoord=None, ycoord=None,
         ply_data = PlyData.read(file)
 
     # Extract the column names dynamically from the PLY header
-    column_names = [prop.name for prop in ply_data['vertex'].properties]
-
-    # Dictionary to map columns based on possible names
-    column_mapping = {}
-    unused_columns = []
-
-    # Extract vertex data into a DataFrame using the dynamic column names
-    df = pd.DataFrame(ply_data['vertex'].data, columns=column_names)
+    vertex = ply_data['vertex']
+    column_names = [prop.name for prop in vertex.properties]
 
-    for col in df.columns:
-        matched = False
-        for var_name, details in variable_mapping.items():
-            if col.lower() in [name.lower() for name in details['possible_names']]:
-                column_mapping[col] = var_name
-                matched = True
-                break
-        if not matched:
-            unused_columns.append(col)
+    # Map columns to variables based on possible names
+    column_mapping, unused_columns = match_columns(column_names, variable_mapping)
 
-    # Rename columns based on the mapping
-    df = df.rename(columns=column_mapping)
-
-    # Drop unused columns and print a message
+    # Print a message about the columns that are left out
     if unused_columns:
         print(f"Removing columns not found in dictionary: {unused_columns}")
-        df = df.drop(columns=unused_columns)
-
-    # Define the chunk size
-    chunk_size = 10_000_000
-
-    # Split the dataframe into a list of smaller dataframes
-    dataframes = [df[i:i + chunk_size] for i in range(0, len(df), chunk_size)]
-
-    if not all(col in dataframes[0].columns for col in ['latitude', 'longitude']):
-        processed_dfs = []
-        for df in dataframes:
-            # Calculate latitude and longitude from X and Y and the CRS
-            lat, lon = utm_to_latlon(df['X'].values, df['Y'].values, cf_crs)
-            df['latitude'], df['longitude'] = lat, lon
-            processed_dfs.append(df)
-        dfs = processed_dfs
-    else:
-        pass
 
-    combined_df = combine_dataframes(dfs)
+    # Build the DataFrame from the vertex arrays of the used columns only, already renamed,
+    # so the data is copied once rather than again when renaming and dropping columns
+    df = pd.DataFrame({column_mapping[name]: vertex[name] for name in column_names if name in column_mapping})
+
+    if not {'latitude', 'longitude'} <= set(df.columns):
+        # Calculate latitude and longitude from X and Y and the CRS, for all points at once
+        df['latitude'], df['longitude'] = utm_to_latlon(df['X'].to_numpy(), df['Y'].to_numpy(), cf_crs)
 
-    return combined_df
+    return df
 
 def read_hyspex(hdr_filepath, need_to_calibrate=False):
 
@@ -239,11 +202,11 @@ def read_hyspex(hdr_filepath, need_to_calibrate=False):
         # Read the file and extract the required fields
         with open(hdr_filepath, 'r') as hdr_file:
             for line in hdr_file:
-                if re.match(r"^lines\s*=", line):
+                if hdr_lines_pattern.match(line):
                     number_of_lines = int(line.split('=')[1].strip())
-                elif re.match(r"^samples\s*=", line):
+                elif hdr_samples_pattern.match(line):
                     number_of_samples = int(line.split('=')[1].strip())
-                elif re.match(r"^interleave\s*=", line):
+                elif hdr_interleave_pattern.match(line):
                     interleave = line.split('=')[1].strip()
 
         hyspex_file = os.path.splitext(hdr_filepath)[0] + ".hyspex"
@@ -256,14 +219,9 @@ def read_hyspex(hdr_filepath, need_to_calibrate=False):
             # Process line by line
             for line in range(number_of_lines):
                 logger.info(f'Calibrating line {line} of {number_of_lines}')
-                # Create the line and sample indices for the current line
-                line_index = [line] * number_of_samples
-                sample_index = list(range(number_of_samples))
-
-                # Calibrate the spectrum for the current line
-                calibrated_line = hrad.calibrate_spectrum(line_index, sample_index)
-                calibrated_line_flattened = calibrated_line.reshape(-1, hdr.nbands)
-                df = pd.DataFrame(calibrated_line_flattened, columns=wavelengths)
+                # Calibrate the spectrum for every sample of the current line
+                calibrated_line = hrad.calibrate_line(line)
+                df = pd.DataFrame(calibrated_line, columns=wavelengths)
                 dataframes.append(df)
 
             logger.info('Combining calibrated hyspex data into a single dataframe')
@@ -275,8 +233,16 @@ def read_hyspex(hdr_filepath, need_to_calibrate=False):
             return None
     else:
         logger.info('No calibration will be performed to hyspex data')
-        spectral_data = hdr.load()
+        spectral_data = None
+        if hdr.scale_factor == 1 and hdr.interleave == sp.BIP:
+            # Memory map bip data rather than loading all of it, so it is only read from disk as it is written
+            # to the NetCDF file. Flattening is then a view. Other interleaves would be copied into memory when
+            # flattened, so they are loaded as before. None is returned if the file cannot be memory mapped
+            spectral_data = hdr.open_memmap(interleave='bip', writable=False)
+        if spectral_data is None:
+            # Any scale factor is applied as the data are loaded, as float32 which is what is written to the file
+            spectral_data = hdr.load(dtype=np.float32)
         spectral_data_flattened = spectral_data.reshape(-1, hdr.nbands) # Flatten the data
         # Columns: wavelengths, 1 row per point
-        df = pd.DataFrame(spectral_data_flattened, columns=wavelengths)
+        df = pd.DataFrame(spectral_data_flattened, columns=wavelengths, copy=False)
         return df
@@ -0,0 +1,159 @@
+'''
+Inverse transverse Mercator projection (e.g. UTM) to latitude and longitude on the WGS84 ellipsoid
+Uses the 6th order Krüger series given by Karney (2011), https://doi.org/10.1007/s00190-011-0445-3
+The series is compiled with numba if it is installed, otherwise it is evaluated with NumPy
+Other projections and datums are left to pyproj, which is also faster than the NumPy version
+'''
+import numpy as np
+
+try:
+    from numba import njit, prange
+    HAS_NUMBA = True
+except ImportError:
+    HAS_NUMBA = False
+
+# WGS84 ellipsoid, the only one supported here as no datum shift is applied
+WGS84_SEMI_MAJOR_AXIS = 6378137.0
+WGS84_INVERSE_FLATTENING = 298.257223563
+
+def _clenshaw_sin(c, cos2, sin2):
+    '''
+    Sum of c[j] * sin(2 * (j + 1) * theta) given cos(2 * theta) and sin(2 * theta), for real or complex theta
+    Clenshaw summation needs only the sine and cosine of 2 * theta rather than one per term
+    '''
+    a = 2.0 * cos2
+    b1 = 0.0 * cos2
+    b2 = 0.0 * cos2
+    for j in range(len(c) - 1, -1, -1):
+        b1, b2 = a * b1 - b2 + c[j], b1
+    return b1 * sin2
+
+def _inverse_point(x, y, lon0, k0, fe, fn, A, xi0, beta, delta):
+    '''
+    Latitude and longitude in degrees of projected x and y
+    Works on scalars or, when not compiled, on whole arrays
+    '''
+    xi = (y - fn) / (k0 * A) + xi0
+    eta = (x - fe) / (k0 * A)
+
+    # Remove the series to get the coordinates on the sphere, with zeta = xi + i * eta
+    cos2xi, sin2xi = np.cos(2.0 * xi), np.sin(2.0 * xi)
+    cosh2eta, sinh2eta = np.cosh(2.0 * eta), np.sinh(2.0 * eta)
+    cos2zeta = cos2xi * cosh2eta - 1j * sin2xi * sinh2eta
+    sin2zeta = sin2xi * cosh2eta + 1j * cos2xi * sinh2eta
+    zeta_p = (xi + 1j * eta) - _clenshaw_sin(beta, cos2zeta, sin2zeta)
+    xi_p = zeta_p.real
+    eta_p = zeta_p.imag
+
+    # Conformal latitude and longitude relative to the central meridian
+    chi = np.arcsin(np.sin(xi_p) / np.cosh(eta_p))
+    lon = lon0 + np.degrees(np.arctan2(np.sinh(eta_p), np.cos(xi_p)))
+    # Wrap to [-180, 180) as pyproj does
+    lon = (lon + 180.0) % 360.0 - 180.0
+
+    # Conformal to geodetic latitude
+    phi = chi + _clenshaw_sin(delta, np.cos(2.0 * chi), np.sin(2.0 * chi))
+
+    return np.degrees(phi), lon
+
+if HAS_NUMBA:
+    _clenshaw_sin = njit(fastmath=True, cache=True)(_clenshaw_sin)
+    _inverse_point_jit = njit(fastmath=True, cache=True)(_inverse_point)
+
+    @njit(parallel=True, fastmath=True, cache=True)
+    def _inverse_kernel(x, y, lon0, k0, fe, fn, A, xi0, beta, delta, lat, lon):
+        for i in prange(x.shape[0]):
+            lat[i], lon[i] = _inverse_point_jit(x[i], y[i], lon0, k0, fe, fn, A, xi0, beta, delta)
+
+def _series_coefficients(f):
+    '''
+    Rectifying radius A and the alpha, beta and delta coefficients of the Krüger series for flattening f
+    '''
+    n = f / (2 - f)
+    n2, n3, n4, n5, n6 = n**2, n**3, n**4, n**5, n**6
+
+    A = WGS84_SEMI_MAJOR_AXIS / (1 + n) * (1 + n2 / 4 + n4 / 64 + n6 / 256)
+
+    alpha = np.array([
+        n / 2 - 2 * n2 / 3 + 5 * n3 / 16 + 41 * n4 / 180 - 127 * n5 / 288 + 7891 * n6 / 37800,
+        13 * n2 / 48 - 3 * n3 / 5 + 557 * n4 / 1440 + 281 * n5 / 630 - 1983433 * n6 / 1935360,
+        61 * n3 / 240 - 103 * n4 / 140 + 15061 * n5 / 26880 + 167603 * n6 / 181440,
+        49561 * n4 / 161280 - 179 * n5 / 168 + 6601661 * n6 / 7257600,
+        34729 * n5 / 80640 - 3418889 * n6 / 1995840,
+        212378941 * n6 / 319334400
+    ])
+    beta = np.array([
+        n / 2 - 2 * n2 / 3 + 37 * n3 / 96 - n4 / 360 - 81 * n5 / 512 + 96199 * n6 / 604800,
+        n2 / 48 + n3 / 15 - 437 * n4 / 1440 + 46 * n5 / 105 - 1118711 * n6 / 3870720,
+        17 * n3 / 480 - 37 * n4 / 840 - 209 * n5 / 4480 + 5569 * n6 / 90720,
+        4397 * n4 / 161280 - 11 * n5 / 504 - 830251 * n6 / 7257600,
+        4583 * n5 / 161280 - 108847 * n6 / 3991680,
+        20648693 * n6 / 638668800
+    ])
+    delta = np.array([
+        2 * n - 2 * n2 / 3 - 2 * n3 + 116 * n4 / 45 + 26 * n5 / 45 - 2854 * n6 / 675,
+        7 * n2 / 3 - 8 * n3 / 5 - 227 * n4 / 45 + 2704 * n5 / 315 + 2323 * n6 / 945,
+        56 * n3 / 15 - 136 * n4 / 35 - 1262 * n5 / 105 + 73814 * n6 / 2835,
+        4279 * n4 / 630 - 332 * n5 / 35 - 399572 * n6 / 14175,
+        4174 * n5 / 315 - 144838 * n6 / 6237,
+        601676 * n6 / 22275
+    ])
+    return A, alpha, beta, delta
+
+def _conformal_latitude(phi, f):
+    '''
+    Conformal latitude in radians of the geodetic latitude phi in radians
+    '''
+    e = np.sqrt(f * (2 - f))
+    return np.arctan(np.sinh(np.arcsinh(np.tan(phi)) - e * np.arctanh(e * np.sin(phi))))
+
+def is_supported(cf_crs):
+    '''
+    True if the CF grid mapping is a transverse Mercator projection on the WGS84 ellipsoid and datum
+    '''
+    try:
+        return (
+            cf_crs.get('grid_mapping_name') == 'transverse_mercator'
+            and cf_crs.get('horizontal_datum_name') == 'World Geodetic System 1984'
+            and float(cf_crs['semi_major_axis']) == WGS84_SEMI_MAJOR_AXIS
+            and float(cf_crs['inverse_flattening']) == WGS84_INVERSE_FLATTENING
+            and float(cf_crs.get('longitude_of_prime_meridian', 0)) == 0
+            and all(key in cf_crs for key in [
+                'latitude_of_projection_origin',
+                'longitude_of_central_meridian',
+                'scale_factor_at_central_meridian',
+                'false_easting',
+                'false_northing'
+            ])
+        )
+    except (AttributeError, TypeError, ValueError, KeyError):
+        return False
+
+def inverse(x, y, cf_crs):
+    '''
+    Latitude and longitude arrays in degrees of the projected x and y arrays
+    cf_crs must be supported, see is_supported
+    '''
+    f = 1 / WGS84_INVERSE_FLATTENING
+    A, alpha, beta, delta = _series_coefficients(f)
+
+    lat0 = float(cf_crs['latitude_of_projection_origin'])
+    lon0 = float(cf_crs['longitude_of_central_meridian'])
+    k0 = float(cf_crs['scale_factor_at_central_meridian'])
+    fe = float(cf_crs['false_easting'])
+    fn = float(cf_crs['false_northing'])
+
+    # Northing of the latitude of origin on the central meridian, zero for UTM
+    chi0 = _conformal_latitude(np.radians(lat0), f)
+    xi0 = chi0 + np.sum(alpha * np.sin(2.0 * np.arange(1, 7) * chi0))
+
+    x = np.ascontiguousarray(x, dtype=np.float64)
+    y = np.ascontiguousarray(y, dtype=np.float64)
+
+    if HAS_NUMBA:
+        lat = np.empty_like(x)
+        lon = np.empty_like(x)
+        _inverse_kernel(x, y, lon0, k0, fe, fn, A, xi0, beta, delta, lat, lon)
+        return lat, lon
+
+    return _inverse_point(x, y, lon0, k0, fe, fn, A, xi0, beta, delta)
@@ -4,12 +4,37 @@ import logging
 
 logger = logging.getLogger(__name__)
 
+# Regular expression to match the format YYYY-MM-DD or YYYY-MM-DDTHH:MM:SSZ
+time_format_pattern = re.compile(r'^\d{4}-\d{2}-\d{2}(T\d{2}:\d{2}:\d{2}Z)?$')
+
+# Regular expressions to match fields in ENVI header files
+hdr_lines_pattern = re.compile(r"^lines\s*=")
+hdr_samples_pattern = re.compile(r"^samples\s*=")
+hdr_interleave_pattern = re.compile(r"^interleave\s*=")
+
 def validate_time_format(time_string):
-    # Regular expression to match the format YYYY-MM-DD or YYYY-MM-DDTHH:MM:SSZ
-    pattern = r'^\d{4}-\d{2}-\d{2}(T\d{2}:\d{2}:\d{2}Z)?$'
-    return bool(re.match(pattern, time_string))
+    return time_format_pattern.match(time_string) is not None
+
+# String values of global attributes that are treated as not provided
+empty_values = frozenset(['', 'None', 'nan'])
+
+def is_empty(value):
+    '''
+    True if a global attribute value is None, NaN or one of the empty_values strings
+    Used both to check the attributes and to leave them out of the NetCDF file
+    '''
+    if value is None:
+        return True
+    if isinstance(value, float):
+        # NaN is the only value not equal to itself
+        return bool(value != value)
+    return isinstance(value, str) and value in empty_values
 
 def define_chunk_size(pc_df, hdr_filepath):
+    '''
+    Chunk size along the point dimension for the 2D intensity variable
+    None if the default chunking in lib/create_netcdf.py should be used
+    '''
     errors = []
     try:
         if hdr_filepath:
@@ -19,9 +44,9 @@ def define_chunk_size(pc_df, hdr_filepath):
             # Read the file and extract the required fields
             with open(hdr_filepath, 'r') as hdr_file:
                 for line in hdr_file:
-                    if re.match(r"^samples\s*=", line):
+                    if hdr_samples_pattern.match(line):
                         number_of_samples = int(line.split('=')[1].strip())
-                    elif re.match(r"^interleave\s*=", line):
+                    elif hdr_interleave_pattern.match(line):
                         interleave = line.split('=')[1].strip()
             if interleave == 'bil': # Data organised line by line
                 logger.info(f'Data will be divided into chunks line by line')
@@ -29,12 +54,7 @@ def define_chunk_size(pc_df, hdr_filepath):
             else:
                 chunk_size = None
         else:
-            num_points = len(pc_df)
-            if num_points > 2000000:
-                chunk_size = 1000000
-                logger.info(f'Data will be divided into chunks of {chunk_size} points')
-            else:
-                chunk_size = None
+            chunk_size = None
 
         return chunk_size, errors
     except:
@@ -1,9 +1,5 @@
-import json
-import os
 import yaml
 import numpy as np
-from lib.utils import validate_time_format
-from datetime import datetime, timezone
 
 # Required attrbutes
 required_attributes = [
@@ -13,11 +9,79 @@ required_attributes = [
     'coverage_content_type'
 ]
 
-no_standard_name_required = [
+# dtypes that can be used for variables in the NetCDF file
+allowed_dtypes = ['f4', 'f8', 'i4', 'i8', 'u1', 'u2', 'S1']
+
+# Attributes that must have the same type as the variable they describe
+valid_range_attributes = ['valid_min', 'valid_max', 'valid_range']
+
+no_standard_name_required = frozenset([
     'px',
     'py',
     'scan_angle_rank'
-]
+])
+
+def valid_range_errors(variable, attributes, dtype):
+    '''
+    Errors for valid_min, valid_max and valid_range values that cannot be stored in the dtype of the variable
+    These attributes are written with the dtype of the variable, so they would otherwise overflow or be truncated
+    '''
+    dtype = np.dtype(dtype)
+    if dtype.kind not in 'iuf':
+        return []
+    # Python numbers, so that the comparisons below are exact and do not overflow
+    if dtype.kind in 'iu':
+        lower, upper = int(np.iinfo(dtype).min), int(np.iinfo(dtype).max)
+    else:
+        lower, upper = float(np.finfo(dtype).min), float(np.finfo(dtype).max)
+    errors = []
+    for attribute in valid_range_attributes:
+        if attribute not in attributes:
+            continue
+        values = attributes[attribute]
+        if not isinstance(values, (list, tuple)):
+            values = [values]
+        for value in values:
+            try:
+                number = float(value)
+            except (TypeError, ValueError):
+                errors.append(f'{attribute} must be a number for the {variable} variable')
+                break
+            if not lower <= (value if isinstance(value, int) else number) <= upper:
+                errors.append(f'{attribute} must be between {lower} and {upper} for the {variable} variable, which has dtype {dtype}')
+                break
+            if dtype.kind in 'iu' and not number.is_integer():
+                errors.append(f'{attribute} must be a whole number for the {variable} variable, which has dtype {dtype}')
+                break
+    return errors
+
+def possible_name_index(variable_mapping):
+    '''
+    Dictionary of {lowercase possible name: variable}
+    If a name is listed for more than one variable, the first variable in the mapping file is used
+    '''
+    index = {}
+    for variable, details in variable_mapping.items():
+        for name in details.get('possible_names', []):
+            index.setdefault(name.lower(), variable)
+    return index
+
+def match_columns(columns, variable_mapping):
+    '''
+    Match the columns in the input data to variables in the mapping file using their possible names
+    Matching is case-insensitive
+    Returns a dictionary of {column: variable} and a list of the columns that could not be matched
+    '''
+    index = possible_name_index(variable_mapping)
+    column_mapping = {}
+    unmatched_columns = []
+    for col in columns:
+        variable = index.get(col.lower())
+        if variable is None:
+            unmatched_columns.append(col)
+        else:
+            column_mapping[col] = variable
+    return column_mapping, unmatched_columns
 
 class VariableMapping:
 
@@ -72,12 +136,13 @@ class VariableMapping:
                             errors.append(f'No "attributes" key found for the {variable} variable')
 
                     if 'dtype' not in self.dict[variable].keys():
-                        errors.append(f'A dtype must be provided for the {variable} variable. Select from f4, f8, i4, i8, S1')
+                        errors.append(f'A dtype must be provided for the {variable} variable. Select from {", ".join(allowed_dtypes)}')
                     else:
-                        if self.dict[variable]['dtype'] not in ['f4','f8','i4','i8','S1']:
-                            errors.append(f'Invalid dtype for the {variable} variable. Select from f4, f8, i4, i8, S1')
+                        if self.dict[variable]['dtype'] not in allowed_dtypes:
+                            errors.append(f'Invalid dtype for the {variable} variable. Select from {", ".join(allowed_dtypes)}')
                         else:
-                            pass
+                            # valid_min, valid_max and valid_range must fit in the dtype they are written with
+                            errors.extend(valid_range_errors(variable, self.dict[variable].get('attributes', {}), self.dict[variable]['dtype']))
                 else:
                     if variable not in ['latitude', 'longitude', 'altitude']: # Variables derived later, not required in input data
                         warnings.append(f"The variable '{variable}' in the mapping file has not been found in the input data. Skipping")
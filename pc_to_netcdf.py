@@ -1,12 +1,16 @@
 import os
 from lib.read_data import read_hyspex, ply_to_df, las_to_df, get_cf_crs, list_variables_in_ply
-from lib.create_netcdf import create_netcdf
+from lib.create_netcdf import create_netcdf, netcdf_formats, compression_levels
 from lib.global_attributes import GlobalAttributes
 from lib.variable_mapping import VariableMapping
 from lib.utils import define_chunk_size
 import argparse
 import yaml
-import toml
+try:
+    import tomllib
+except ImportError:
+    # Python < 3.11
+    import tomli as tomllib
 import json
 import sys
 import logging
@@ -36,23 +40,33 @@ def is_valid_toml(file_path):
     """Check if the file is a valid TOML file."""
     if os.path.isfile(file_path) and file_path.endswith('.toml'):
         try:
-            with open(file_path, 'r') as f:
-                toml.load(f)
+            with open(file_path, 'rb') as f:
+                tomllib.load(f)
             return True
-        except toml.TomlDecodeError:
+        except tomllib.TOMLDecodeError:
             return False
     return False
 
 
-def main():
-
-    # Log to console
-    logger = logging.getLogger()
-    logger.setLevel(logging.DEBUG)
+def setup_logging():
+    '''
+    Log to console. Only done once per process, so that converting several files does not duplicate the output
+    '''
+    root_logger = logging.getLogger()
+    if root_logger.handlers:
+        return
+    root_logger.setLevel(logging.DEBUG)
     log_info = logging.StreamHandler(sys.stdout)
     log_info.setFormatter(logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s'))
-    logger.addHandler(log_info)
+    root_logger.addHandler(log_info)
+
 
+def main(argv=None, workers=1):
+    '''
+    Convert a point cloud file to a CF-NetCDF file
+    argv: list of command line arguments. Taken from sys.argv if None
+    workers: number of files being converted at the same time, e.g. by convert_multiple_files.py
+    '''
     logger.info("Parsing arguments")
 
     parser = argparse.ArgumentParser(description='Convert a point cloud file to a NetCDF file.')
@@ -113,7 +127,24 @@ def main():
     # Output filepath
     parser.add_argument('-o', '--output_filepath', type=str, default=None, help='Path to the output NetCDF file. If not provided, defaults to a subfolder "output" in the git repo with the same name as the input CSV file but with .nc extension.')
 
-    args = parser.parse_args()
+    parser.add_argument(
+        '-f',
+        '--netcdf_format',
+        type=str,
+        default='NETCDF4',
+        choices=netcdf_formats,
+        help='Format of the output NetCDF file. Only NETCDF4 and NETCDF4_CLASSIC support compression. Defaults to NETCDF4.'
+        )
+    parser.add_argument(
+        '-c',
+        '--compression',
+        type=str,
+        default='zlib',
+        choices=list(compression_levels),
+        help='Compression method for the data variables. zstd and blosc require netCDF-C to be built with these filters, otherwise zlib is used. Defaults to zlib.'
+        )
+
+    args = parser.parse_args(argv)
 
     if args.crs_config and args.proj4str:
         parser.error("You cannot specify both --crs_config and --proj4str. Please provide only one or neither if the proj4 string is in the comment in the header of the PLY file.")
@@ -264,9 +295,10 @@ def main():
 
         logger.info("Trying to create CF-NetCDF file")
         # Convert the DataFrame to a NetCDF file
-        create_netcdf(pc_df, wavelength_df, variable_mapping.dict, args.output_filepath, global_attributes.dict, cf_crs, chunk_size)
+        create_netcdf(pc_df, wavelength_df, variable_mapping.dict, args.output_filepath, global_attributes.dict, cf_crs, chunk_size, args.netcdf_format, args.compression, workers)
         logger.info(f'File created: {args.output_filepath}')
 
 if __name__ == '__main__':
+    setup_logging()
     main()
 